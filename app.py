@@ -1,29 +1,86 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import httpx
-import requests
 from pydantic import BaseModel
+import asyncio
+import random
 import threading
-from typing import List
+from typing import Tuple
+import os
 import time
 import logging
 
 # Configure logging to stdout (appears in docker logs)
 logging.basicConfig(
-    level=logging.INFO,
+    # Per-request INFO lines are expensive at high QPS (formatting + stdout
+    # writes through Docker's log driver); default to WARNING, opt back in
+    # with LOG_LEVEL=INFO when debugging
+    level=getattr(logging, os.getenv("LOG_LEVEL", "WARNING").upper(), logging.WARNING),
     format="%(asctime)s [%(levelname)s] %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Ollama Swarm Proxy")
-
-# Global state with lock protection
-ollama_hosts: List[str] = []
-lock = threading.Lock()
-# Thread-safe counter for round-robin host selection
-_host_counter = 0
-_counter_lock = threading.Lock()
+# orjson serializes the admin/registration payloads several times faster
+# than stdlib json and emits bytes directly
+app = FastAPI(title="Ollama Swarm Proxy", default_response_class=ORJSONResponse)
+
+# 64 KiB matches typical kernel/nginx socket buffers and keeps per-chunk
+# Python overhead low on large generations; override via env if needed
+PROXY_CHUNK_SIZE = int(os.getenv("PROXY_CHUNK_SIZE", "65536"))
+
+# Per-path timeout overrides (model transfers are slow); everything else
+# gets the default. Dict lookup beats a substring scan per request.
+_PATH_TIMEOUTS = {"api/pull": 600.0, "api/push": 600.0}
+_DEFAULT_TIMEOUT = 60.0
+
+# Failover: retry a request on at most this many hosts, and only for
+# upstream-availability failures — 4xx means the request itself is bad
+_MAX_ATTEMPTS = 3
+_RETRYABLE_STATUS = (502, 503, 504)
+
+@app.on_event("startup")
+async def startup_client():
+    # One shared client for the app's lifetime: keeps connections alive across
+    # requests instead of paying DNS + TCP + TLS setup on every proxied call.
+    # The pool is sized for bursts against a small host set, with keep-alive
+    # held long enough that inference streams reuse already-open sockets;
+    # http2 multiplexes when a host negotiates it. Long read tolerance covers
+    # slow generations — per-path overrides still apply via build_request.
+    app.state.client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(connect=5.0, read=600.0, write=60.0, pool=5.0),
+        limits=httpx.Limits(
+            max_connections=1024,
+            max_keepalive_connections=512,
+            keepalive_expiry=120.0,
+        ),
+    )
+
+@app.on_event("shutdown")
+async def shutdown_client():
+    await app.state.client.aclose()
+
+# Registered hosts as an immutable tuple (copy-on-write): writers rebuild it
+# under `_hosts_lock`, readers just snapshot the current tuple with no
+# locking — the rebind is atomic under the GIL and registration is rare.
+# The lock exists solely to make the check-then-rebuild in register/
+# unregister atomic; no reader ever takes it.
+_hosts: Tuple[str, ...] = ()
+_hosts_lock = threading.Lock()
+# In-flight request count per host, used for two-choice selection. Counts
+# need not be exact under contention, so no lock here either.
+_in_flight: dict = {}
+
+def _acquire_host(host: str) -> None:
+    _in_flight[host] = _in_flight.get(host, 0) + 1
+
+def _release_host(host: str) -> None:
+    remaining = _in_flight.get(host, 1) - 1
+    if remaining <= 0:
+        _in_flight.pop(host, None)
+    else:
+        _in_flight[host] = remaining
 
 class Host(BaseModel):
     url: str
@@ -31,174 +88,220 @@ class Host(BaseModel):
 class ModelCommand(BaseModel):
     model: str
 
-# Removed update_cycle - using atomic counter instead
-
 @app.post("/register")
 def register_host(host: Host):
-    with lock:
-        if host.url not in ollama_hosts:
-            ollama_hosts.append(host.url)
-            logger.info(f"Registered new host: {host.url} | Current hosts: {ollama_hosts}")
-        else:
-            logger.info(f"Host already registered: {host.url}")
-    return {"status": "registered", "hosts": ollama_hosts}
+    global _hosts
+    # Normalize once here so the per-request URL build is plain concatenation
+    url = host.url.rstrip('/')
+    with _hosts_lock:
+        added = url not in _hosts
+        if added:
+            _hosts = (*_hosts, url)
+    if added:
+        logger.info("Registered new host: %s | Current hosts: %s", url, list(_hosts))
+    else:
+        logger.info("Host already registered: %s", url)
+    return {"status": "registered", "hosts": list(_hosts)}
 
 @app.post("/unregister")
 def unregister_host(host: Host):
-    with lock:
-        if host.url in ollama_hosts:
-            ollama_hosts.remove(host.url)
-            logger.info(f"Unregistered host: {host.url} | Remaining: {ollama_hosts}")
-        else:
-            logger.info(f"Host not found: {host.url}")
-    return {"status": "unregistered", "hosts": ollama_hosts}
+    global _hosts
+    url = host.url.rstrip('/')
+    with _hosts_lock:
+        removed = url in _hosts
+        if removed:
+            _hosts = tuple(h for h in _hosts if h != url)
+    if removed:
+        logger.info("Unregistered host: %s | Remaining: %s", url, list(_hosts))
+    else:
+        logger.info("Host not found: %s", url)
+    return {"status": "unregistered", "hosts": list(_hosts)}
 
 @app.get("/hosts")
 def list_hosts():
-    return {"hosts": ollama_hosts}
+    return {"hosts": list(_hosts)}
 
-async def forward_request(method: str, path: str, data: dict, host: str, stream: bool = True):
-    url = f"{host.rstrip('/')}/{path.lstrip('/')}"
-    start_time = time.time()
+async def forward_request(client: httpx.AsyncClient, method: str, path: str, body: bytes, headers: dict, host: str, start_time: float):
+    # Hosts are normalized at registration and FastAPI's {path:path} has no
+    # leading slash, so plain concatenation is enough. start_time is the
+    # caller's monotonic t0, shared so we don't read the clock again here.
+    url = host + "/" + path
 
-    # Use shorter timeout for normal inference, longer for pulling models
-    timeout = 600.0 if "pull" in path else 60.0
+    timeout = _PATH_TIMEOUTS.get(path, _DEFAULT_TIMEOUT)
 
     try:
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            if method == "GET":
-                response = await client.get(url, params=data if data else None, follow_redirects=True)
-            elif method == "POST":
-                response = await client.post(url, json=data, follow_redirects=True)
-            else:
-                raise ValueError(f"Unsupported method: {method}")
+        # build_request takes the method directly, so no if/elif ladder; GET
+        # passes no body (content=None), POST forwards the raw bytes untouched
+        req = client.build_request(method, url, content=body or None, headers=headers, timeout=timeout)
 
+        # stream=True defers the body: we relay chunks to the client as they
+        # arrive instead of buffering the whole generation in memory
+        response = await client.send(req, stream=True, follow_redirects=True)
+        try:
             response.raise_for_status()
-            duration = time.time() - start_time
-            logger.info(f"Success → {host} | {method} /{path} | {duration:.3f}s")
-            return response
+        except httpx.HTTPStatusError:
+            await response.aclose()
+            raise
+        duration = time.monotonic() - start_time
+        logger.info("Success → %s | %s /%s | %.3fs", host, method, path, duration)
+        return response
 
     except httpx.RequestError as e:
-        duration = time.time() - start_time
-        logger.error(f"Failed → {host} | {method} /{path} | {duration:.3f}s | Error: {str(e)}")
+        duration = time.monotonic() - start_time
+        logger.error("Failed → %s | %s /%s | %.3fs | Error: %s", host, method, path, duration, e)
         raise HTTPException(status_code=502, detail=f"Host {host} failed: {str(e)}")
     except httpx.HTTPStatusError as e:
-        duration = time.time() - start_time
-        logger.error(f"HTTP Error → {host} | {method} /{path} | {duration:.3f}s | Status: {e.response.status_code}")
+        duration = time.monotonic() - start_time
+        logger.error("HTTP Error → %s | %s /%s | %.3fs | Status: %s", host, method, path, duration, e.response.status_code)
         raise HTTPException(status_code=e.response.status_code, detail=f"Host {host} returned error: {e.response.status_code}")
 
-def get_next_host() -> str:
-    """Get next host using thread-safe atomic counter for round-robin distribution"""
-    global _host_counter
-    
-    # Get host count atomically and increment counter
-    with _counter_lock:
-        if not ollama_hosts:
-            raise HTTPException(status_code=503, detail="No Ollama hosts registered")
-        host_count = len(ollama_hosts)
-        # Use modulo for round-robin, increment counter
-        host = ollama_hosts[_host_counter % host_count]
-        _host_counter += 1
-    
-    logger.info(f"Routing request to: {host}")
-    return host
+def get_next_host() -> Tuple[str, int]:
+    """Pick a host by power-of-two-choices on in-flight request counts.
+
+    Round-robin hands a slow host the same 1/N share as a fast one; sampling
+    two random hosts and taking the less loaded keeps the maximum load close
+    to the mean without any coordination. Returns (host, index) so failover
+    can walk the tuple from the index instead of re-scanning for the host.
+    """
+    # Snapshot the tuple so a concurrent register/unregister can't change it
+    # between the length check and the index
+    hosts = _hosts
+    n = len(hosts)
+    if n == 0:
+        raise HTTPException(status_code=503, detail="No Ollama hosts registered")
+    if n == 1:
+        idx = 0
+    else:
+        a = random.randrange(n)
+        b = random.randrange(n - 1)
+        if b >= a:
+            b += 1  # distinct second choice
+        idx = a if _in_flight.get(hosts[a], 0) <= _in_flight.get(hosts[b], 0) else b
+
+    host = hosts[idx]
+    logger.info("Routing request to: %s", host)
+    return host, idx
 
 # ────────────────────────────────────────────────
 # Admin endpoints (must be defined before catch-all route)
 # ────────────────────────────────────────────────
 
+async def _pull_one(client: httpx.AsyncClient, host: str, model_name: str):
+    start = time.monotonic()
+    try:
+        r = await client.post(f"{host}/api/pull", json={"model": model_name}, timeout=600)
+        r.raise_for_status()
+        logger.info("Pull success on %s | %.2fs", host, time.monotonic()-start)
+        return host, "success"
+    except Exception as e:
+        logger.error("Pull failed on %s | %.2fs | %s", host, time.monotonic()-start, e)
+        return host, f"failed: {str(e)}"
+
 @app.post("/admin/pull")
-def admin_pull(model: ModelCommand):
-    results = {}
-    with lock:
-        for host in ollama_hosts[:]:  # copy to avoid modification during iteration
-            start = time.time()
-            try:
-                r = requests.post(
-                    f"{host}/api/pull",
-                    json={"model": model.model},
-                    timeout=600,
-                    stream=True
-                )
-                r.raise_for_status()
-                results[host] = "success"
-                logger.info(f"Pull success on {host} | {time.time()-start:.2f}s")
-            except Exception as e:
-                results[host] = f"failed: {str(e)}"
-                logger.error(f"Pull failed on {host} | {time.time()-start:.2f}s | {str(e)}")
+async def admin_pull(model: ModelCommand, request: Request):
+    # Fan out to all hosts at once: wall time is the slowest host, not the sum
+    hosts = _hosts  # immutable snapshot, no lock needed
+    client = request.app.state.client
+    results = dict(await asyncio.gather(*(_pull_one(client, h, model.model) for h in hosts)))
     return {"results": results}
 
 
+async def _list_models_one(client: httpx.AsyncClient, host: str):
+    try:
+        response = await client.get(f"{host}/api/tags", timeout=15)
+        response.raise_for_status()
+        return host, response.json()
+    except Exception as e:
+        # Broad on purpose: a 200 with a non-JSON body raises JSONDecodeError,
+        # and this endpoint's job is to report the bad host, not 500
+        return host, f"failed: {str(e)}"
+
 @app.get("/admin/list_models")
-def admin_list_models():
-    results = {}
-    with lock:
-        for host in ollama_hosts:
-            try:
-                response = requests.get(f"{host}/api/tags", timeout=15)
-                response.raise_for_status()
-                results[host] = response.json()
-            except requests.RequestException as e:
-                results[host] = f"failed: {str(e)}"
+async def admin_list_models(request: Request):
+    hosts = _hosts  # immutable snapshot, no lock needed
+    client = request.app.state.client
+    results = dict(await asyncio.gather(*(_list_models_one(client, h) for h in hosts)))
     return {"results": results}
 
 @app.api_route("/{path:path}", methods=["GET", "POST"])
 async def proxy(request: Request, path: str):
-    start_total = time.time()
-    data = await request.json() if request.method == "POST" else {}
+    start_total = time.monotonic()
+    # Pass the body through as opaque bytes; Ollama gets the exact payload
+    body = await request.body() if request.method == "POST" else b""
+    fwd_headers = {"Content-Type": request.headers.get("content-type", "application/json")}
 
-    # We'll try all hosts in worst case, but prefer round-robin start
-    tried_hosts = []
-    original_host = get_next_host()
-    current_host = original_host
+    # We'll try all hosts in worst case, but cap attempts on failover
+    tried_hosts = set()
+    current_host, current_idx = get_next_host()
 
     while True:
-        tried_hosts.append(current_host)
+        tried_hosts.add(current_host)
+        # Count this host as loaded until its stream finishes (or it fails)
+        _acquire_host(current_host)
+        held_host = current_host
 
         try:
-            response = await forward_request(request.method, path, data, current_host)
-            duration_total = time.time() - start_total
-            logger.info(f"Total request time: {duration_total:.3f}s | Path: /{path} | Host: {current_host}")
+            response = await forward_request(request.app.state.client, request.method, path, body, fwd_headers, current_host, start_total)
+            duration_total = time.monotonic() - start_total
+            logger.info("Total request time: %.3fs | Path: /%s | Host: %s", duration_total, path, current_host)
 
-            # Stream the response content
+            # Relay the upstream body chunk-by-chunk; close the connection
+            # and release the host's in-flight slot once the client is done
+            # (or disconnects)
             async def stream_gen():
-                # Yield response content in chunks
-                content = response.content
-                chunk_size = 8192
-                for i in range(0, len(content), chunk_size):
-                    yield content[i:i + chunk_size]
+                try:
+                    async for chunk in response.aiter_raw(chunk_size=PROXY_CHUNK_SIZE):
+                        yield chunk
+                finally:
+                    await response.aclose()
+                    _release_host(held_host)
 
             # Get content type, defaulting appropriately
             content_type = response.headers.get("Content-Type", "application/json")
-            if "text/event-stream" in content_type or "application/x-ndjson" in content_type:
-                # Preserve streaming content types
-                pass
+
+            # Only token streams need the anti-buffering headers; plain JSON
+            # responses skip them
+            headers = {}
+            if "application/x-ndjson" in content_type or "text/event-stream" in content_type:
+                # Tell nginx (and friends) not to re-buffer or cache the stream
+                headers["X-Accel-Buffering"] = "no"
+                headers["Cache-Control"] = "no-cache"
 
             return StreamingResponse(
                 stream_gen(),
                 media_type=content_type,
-                status_code=response.status_code
+                status_code=response.status_code,
+                headers=headers
             )
 
         except HTTPException as e:
-            logger.warning(f"Failed on {current_host}, trying next")
-
-            # Get next host for failover
-            with lock:
-                if not ollama_hosts:
-                    raise HTTPException(status_code=503, detail="No Ollama hosts registered")
-                # Find next host that hasn't been tried
-                current_idx = ollama_hosts.index(current_host) if current_host in ollama_hosts else -1
-                next_candidate = None
-                for i in range(len(ollama_hosts)):
-                    candidate_idx = (current_idx + i + 1) % len(ollama_hosts)
-                    candidate = ollama_hosts[candidate_idx]
-                    if candidate not in tried_hosts:
-                        next_candidate = candidate
-                        break
+            _release_host(held_host)
+            # Re-raise client errors untouched: retrying a 400 on another
+            # host just multiplies load for the same failure
+            if e.status_code not in _RETRYABLE_STATUS:
+                raise
+            logger.warning("Failed on %s, trying next", current_host)
+
+            # Get next host for failover from an immutable snapshot
+            hosts = _hosts
+            if not hosts:
+                raise HTTPException(status_code=503, detail="No Ollama hosts registered")
+            # Cap total attempts so a broken request can't sweep the swarm
+            if len(tried_hosts) >= min(len(hosts), _MAX_ATTEMPTS):
+                raise HTTPException(status_code=503, detail="All available hosts failed")
+            # Walk the tuple outward from the failed index for the first
+            # untried candidate — no hosts.index() scan needed
+            n = len(hosts)
+            next_candidate = None
+            for off in range(1, n + 1):
+                j = (current_idx + off) % n
+                if hosts[j] not in tried_hosts:
+                    next_candidate = hosts[j]
+                    current_idx = j
+                    break
 
             # Avoid infinite loop - stop if we've tried everyone
-            if next_candidate is None or next_candidate in tried_hosts:
+            if next_candidate is None:
                 raise HTTPException(status_code=503, detail="All available hosts failed")
 
             current_host = next_candidate
@@ -206,4 +309,15 @@ async def proxy(request: Request, path: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # NOTE: host state (_hosts, _in_flight) is per-process, so WORKERS > 1
+    # needs every worker to receive its own /register calls (or a shared
+    # store such as Redis). Default stays at 1 until that exists.
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", "1")),
+        log_level="warning",
+    )
\ No newline at end of file